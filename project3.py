@@ -1,12 +1,54 @@
 import sys
 import os
 import csv
-
-BLOCK_SIZE = 512
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+
+BLOCK_SIZE = 4096
 MAGIC = b"4348PRJ3"
-T = 10
+T = 85
 MAX_KEYS = 2 * T - 1
 MAX_CHILDREN = 2 * T
+DEFAULT_CACHE_SIZE = 2048
+MIN_CACHE_SIZE = 3
+DIRTY_QUEUE_SIZE = 64
+PREALLOC_BLOCKS = 64
+BLOOM_BITS_PER_KEY = 10
+BLOOM_MIN_LOG2 = 15
+BLOOM_MULT_1 = 0x9E3779B97F4A7C15
+BLOOM_MULT_2 = 0xC2B2AE3D27D4EB4F
+MASK64 = (1 << 64) - 1
+OUTPUT_CHUNK = 8192
+FORMAT_VERSION = 3
+LEGACY_VERSION = 1
+LEGACY_BLOCK_SIZE = 512
+LEGACY_T = 10
+HEADER_STRUCT = struct.Struct("<8sQQB7xQQQQB")
+VERSION_OFFSET = 24
+LEGACY_HEADER_STRUCT = struct.Struct(">8sQQ")
+NODE_STRUCT = struct.Struct("<3Q")
+LEGACY_NODE_STRUCTS = {
+    1: struct.Struct(">" + "Q" * (3 + 2 * (2 * LEGACY_T - 1) + 2 * LEGACY_T)),
+    2: struct.Struct("<" + "Q" * (3 + 2 * (2 * LEGACY_T - 1) + 2 * LEGACY_T)),
+}
+NODE_BYTES = NODE_STRUCT.size + 8 * (2 * MAX_KEYS + MAX_CHILDREN)
+NATIVE_LITTLE = sys.byteorder == "little"
+
+
+def insert_shift(keys, values, num_keys, key, value):
+    i = bisect_right(keys, key, 0, num_keys)
+    keys[i + 1:num_keys + 1] = keys[i:num_keys]
+    values[i + 1:num_keys + 1] = values[i:num_keys]
+    keys[i] = key
+    values[i] = value
+
+
+def fits_uint64(n):
+    return 0 <= n <= MASK64
 
 
 class Header:
@@ -14,33 +56,84 @@ class Header:
         self.magic = MAGIC
         self.root_block = 0
         self.next_block = 1
+        self.version = FORMAT_VERSION
+        self.key_count = 0
+        self.min_key = 0
+        self.max_key = 0
+        self.bloom_block = 0
+        self.bloom_log2 = 0
 
     @staticmethod
-    def from_file(f):
-        f.seek(0)
-        data = f.read(BLOCK_SIZE)
-        if len(data) != BLOCK_SIZE:
+    def from_file(mm):
+        data = mm[0:HEADER_STRUCT.size]
+        if len(data) != HEADER_STRUCT.size:
             raise ValueError("Failed to read header")
-        magic = data[0:8]
-        if magic != MAGIC:
-            raise ValueError("Invalid magic")
         h = Header()
-        h.magic = magic
-        h.root_block = int.from_bytes(data[8:16], "big", signed=False)
-        h.next_block = int.from_bytes(data[16:24], "big", signed=False)
+        if data[VERSION_OFFSET] == 0:
+            h.magic, h.root_block, h.next_block = LEGACY_HEADER_STRUCT.unpack_from(data)
+            h.version = LEGACY_VERSION
+        else:
+            (h.magic, h.root_block, h.next_block, h.version, h.key_count,
+             h.min_key, h.max_key, h.bloom_block, h.bloom_log2) = HEADER_STRUCT.unpack_from(data)
+        if h.magic != MAGIC:
+            raise ValueError("Invalid magic")
+        if h.version > FORMAT_VERSION:
+            raise ValueError("Unsupported format version")
         return h
 
     def to_bytes(self):
         buf = bytearray(BLOCK_SIZE)
-        buf[0:8] = self.magic
-        buf[8:16] = self.root_block.to_bytes(8, "big", signed=False)
-        buf[16:24] = self.next_block.to_bytes(8, "big", signed=False)
+        HEADER_STRUCT.pack_into(buf, 0, self.magic, self.root_block, self.next_block, self.version,
+                                self.key_count, self.min_key, self.max_key,
+                                self.bloom_block, self.bloom_log2)
         return bytes(buf)
 
-    def write(self, f):
-        f.seek(0)
-        f.write(self.to_bytes())
-        f.flush()
+    def write(self, mm):
+        mm[0:BLOCK_SIZE] = self.to_bytes()
+
+
+class BloomFilter:
+    def __init__(self, log2=BLOOM_MIN_LOG2, bits=None, offset=0):
+        self.log2 = log2
+        self.shift = 64 - log2
+        self.size = 1 << (log2 - 3)
+        self.dirty = bits is None
+        if bits is None:
+            bits = bytearray(self.size)
+        self.bits = bits
+        self.offset = offset
+
+    @staticmethod
+    def sized_for(count):
+        log2 = BLOOM_MIN_LOG2
+        while (1 << log2) < 2 * BLOOM_BITS_PER_KEY * count:
+            log2 += 1
+        return BloomFilter(log2)
+
+    @staticmethod
+    def open(mm, block_id, log2):
+        offset = block_id * BLOCK_SIZE
+        if offset + (1 << (log2 - 3)) > len(mm):
+            raise ValueError("Failed to read bloom filter")
+        return BloomFilter(log2, mm, offset)
+
+    def add(self, key):
+        if not self.dirty:
+            self.bits = bytearray(self.bits[self.offset:self.offset + self.size])
+            self.offset = 0
+            self.dirty = True
+        h1 = ((key * BLOOM_MULT_1) & MASK64) >> self.shift
+        h2 = ((key * BLOOM_MULT_2) & MASK64) >> self.shift
+        self.bits[h1 >> 3] |= 1 << (h1 & 7)
+        self.bits[h2 >> 3] |= 1 << (h2 & 7)
+
+    def might_contain(self, key):
+        h1 = ((key * BLOOM_MULT_1) & MASK64) >> self.shift
+        h2 = ((key * BLOOM_MULT_2) & MASK64) >> self.shift
+        bits = self.bits
+        offset = self.offset
+        return bool(bits[offset + (h1 >> 3)] & (1 << (h1 & 7))
+                    and bits[offset + (h2 >> 3)] & (1 << (h2 & 7)))
 
 
 class Node:
@@ -48,94 +141,81 @@ class Node:
         self.block_id = block_id
         self.parent_id = parent_id
         self.num_keys = 0
-        self.keys = [0] * MAX_KEYS
-        self.values = [0] * MAX_KEYS
-        self.children = [0] * MAX_CHILDREN
+        self.keys = array("Q", [0]) * MAX_KEYS
+        self.values = array("Q", [0]) * MAX_KEYS
+        self.children = array("Q", [0]) * MAX_CHILDREN
+        self.leaf = True
         self.dirty = True
 
     @staticmethod
-    def read(f, block_id):
-        f.seek(block_id * BLOCK_SIZE)
-        data = f.read(BLOCK_SIZE)
+    def read(mm, block_id):
+        offset = block_id * BLOCK_SIZE
+        data = mm[offset:offset + BLOCK_SIZE]
         if len(data) != BLOCK_SIZE:
             raise ValueError("Failed to read node")
-        offset = 0
-        stored_block_id = int.from_bytes(data[offset:offset + 8], "big", signed=False)
-        offset += 8
-        parent_id = int.from_bytes(data[offset:offset + 8], "big", signed=False)
-        offset += 8
-        num_keys = int.from_bytes(data[offset:offset + 8], "big", signed=False)
-        offset += 8
-        keys = []
-        for _ in range(MAX_KEYS):
-            keys.append(int.from_bytes(data[offset:offset + 8], "big", signed=False))
-            offset += 8
-        values = []
-        for _ in range(MAX_KEYS):
-            values.append(int.from_bytes(data[offset:offset + 8], "big", signed=False))
-            offset += 8
-        children = []
-        for _ in range(MAX_CHILDREN):
-            children.append(int.from_bytes(data[offset:offset + 8], "big", signed=False))
-            offset += 8
+        stored_block_id, parent_id, num_keys = NODE_STRUCT.unpack_from(data)
+        body = array("Q")
+        body.frombytes(data[NODE_STRUCT.size:NODE_BYTES])
+        if not NATIVE_LITTLE:
+            body.byteswap()
+        keys = body[0:MAX_KEYS]
+        values = body[MAX_KEYS:2 * MAX_KEYS]
+        children = body[2 * MAX_KEYS:]
         n = Node(block_id=stored_block_id, parent_id=parent_id)
         n.num_keys = num_keys
         n.keys = keys
         n.values = values
         n.children = children
+        n.leaf = children[0] == 0
         n.dirty = False
         return n
 
     def to_bytes(self):
         buf = bytearray(BLOCK_SIZE)
-        offset = 0
-        buf[offset:offset + 8] = self.block_id.to_bytes(8, "big", signed=False)
-        offset += 8
-        buf[offset:offset + 8] = self.parent_id.to_bytes(8, "big", signed=False)
-        offset += 8
-        buf[offset:offset + 8] = self.num_keys.to_bytes(8, "big", signed=False)
-        offset += 8
-        for i in range(MAX_KEYS):
-            buf[offset:offset + 8] = self.keys[i].to_bytes(8, "big", signed=False)
-            offset += 8
-        for i in range(MAX_KEYS):
-            buf[offset:offset + 8] = self.values[i].to_bytes(8, "big", signed=False)
-            offset += 8
-        for i in range(MAX_CHILDREN):
-            buf[offset:offset + 8] = self.children[i].to_bytes(8, "big", signed=False)
-            offset += 8
+        NODE_STRUCT.pack_into(buf, 0, self.block_id, self.parent_id, self.num_keys)
+        body = self.keys + self.values + self.children
+        if not NATIVE_LITTLE:
+            body.byteswap()
+        buf[NODE_STRUCT.size:NODE_BYTES] = body.tobytes()
         return bytes(buf)
 
-    def write(self, f):
-        f.seek(self.block_id * BLOCK_SIZE)
-        f.write(self.to_bytes())
-        f.flush()
+    def write(self, mm):
+        offset = self.block_id * BLOCK_SIZE
+        mm[offset:offset + BLOCK_SIZE] = self.to_bytes()
         self.dirty = False
 
-    def is_leaf(self):
-        for i in range(self.num_keys + 1):
-            if self.children[i] != 0:
-                return False
-        return True
-
 
 class NodeCache:
-    def __init__(self, f):
-        self.f = f
-        self.cache = {}
-        self.order = []
+    def __init__(self, mm, capacity=DEFAULT_CACHE_SIZE):
+        self.mm = mm
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.pinned = set()
+        self.dirty_queue = {}
+
+    def pin(self, block_ids):
+        self.pinned = set(block_ids)
 
     def _touch(self, block_id):
-        if block_id in self.order:
-            self.order.remove(block_id)
-        self.order.insert(0, block_id)
+        self.cache.move_to_end(block_id)
 
     def _evict_if_needed(self):
-        while len(self.cache) >= 3:
-            victim = self.order.pop()
+        while len(self.cache) >= self.capacity + len(self.pinned):
+            for victim in self.cache:
+                if victim not in self.pinned:
+                    break
+            else:
+                return
             node = self.cache.pop(victim)
             if node.dirty:
-                node.write(self.f)
+                self.dirty_queue[victim] = node
+                if len(self.dirty_queue) >= DIRTY_QUEUE_SIZE:
+                    self._drain_dirty_queue()
+
+    def _drain_dirty_queue(self):
+        for block_id in sorted(self.dirty_queue):
+            self.dirty_queue[block_id].write(self.mm)
+        self.dirty_queue.clear()
 
     def get(self, block_id):
         if block_id in self.cache:
@@ -143,7 +223,9 @@ class NodeCache:
             self._touch(block_id)
             return node
         self._evict_if_needed()
-        node = Node.read(self.f, block_id)
+        node = self.dirty_queue.pop(block_id, None)
+        if node is None:
+            node = Node.read(self.mm, block_id)
         self.cache[block_id] = node
         self._touch(block_id)
         return node
@@ -156,97 +238,259 @@ class NodeCache:
         return node
 
     def flush_all(self):
+        self._drain_dirty_queue()
         for node in self.cache.values():
             if node.dirty:
-                node.write(self.f)
+                node.write(self.mm)
 
 
 class BTree:
-    def __init__(self, filename, must_exist):
+    def __init__(self, filename, must_exist, cache_size=DEFAULT_CACHE_SIZE):
         mode = "r+b" if must_exist else "w+b"
         if must_exist and not os.path.exists(filename):
             raise ValueError("Index file does not exist")
         if not must_exist and os.path.exists(filename):
             raise ValueError("File already exists")
         self.f = open(filename, mode)
-        if must_exist:
-            self.header = Header.from_file(self.f)
-        else:
-            self.header = Header()
-            self.header.write(self.f)
-        self.cache = NodeCache(self.f)
+        if not must_exist:
+            self.f.write(Header().to_bytes())
+            self.f.flush()
+        self._map(cache_size)
+        if not must_exist:
+            self.bloom = BloomFilter()
+        elif self.header.version < FORMAT_VERSION:
+            self._upgrade(filename, cache_size)
+        self._pin_top()
+
+    def _map(self, cache_size):
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.header = Header.from_file(self.mm)
+        self.cache = NodeCache(self.mm, cache_size)
+        self.bloom = None
+        if self.header.version == FORMAT_VERSION and self.header.bloom_log2 != 0:
+            self.bloom = BloomFilter.open(self.mm, self.header.bloom_block, self.header.bloom_log2)
 
     def close(self):
         self.cache.flush_all()
-        self.header.write(self.f)
+        if self.bloom is not None and self.bloom.dirty:
+            self.header.bloom_block = self.header.next_block
+            self.header.bloom_log2 = self.bloom.log2
+            offset = self.header.bloom_block * BLOCK_SIZE
+            self._ensure_size(offset + self.bloom.size)
+            self.mm[offset:offset + self.bloom.size] = self.bloom.bits
+        self.header.write(self.mm)
+        self.mm.flush()
+        self.mm.close()
         self.f.close()
 
+    def _upgrade(self, filename, cache_size):
+        pairs = []
+        if self.header.root_block != 0:
+            self._read_legacy_node(self.header.root_block, pairs)
+        tmp_name = filename + ".upgrade"
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        new_tree = BTree(tmp_name, must_exist=False, cache_size=cache_size)
+        try:
+            if pairs:
+                new_tree.bulk_load(pairs)
+            new_tree.close()
+        except BaseException:
+            if not new_tree.mm.closed:
+                new_tree.mm.close()
+            new_tree.f.close()
+            os.remove(tmp_name)
+            raise
+        self.mm.close()
+        self.f.close()
+        os.replace(tmp_name, filename)
+        self.f = open(filename, "r+b")
+        self._map(cache_size)
+
+    def _read_legacy_node(self, block_id, pairs):
+        node_struct = LEGACY_NODE_STRUCTS[self.header.version]
+        max_keys = 2 * LEGACY_T - 1
+        offset = block_id * LEGACY_BLOCK_SIZE
+        data = self.mm[offset:offset + LEGACY_BLOCK_SIZE]
+        if len(data) != LEGACY_BLOCK_SIZE:
+            raise ValueError("Failed to read node")
+        fields = node_struct.unpack_from(data)
+        num_keys = fields[2]
+        keys = fields[3:3 + max_keys]
+        values = fields[3 + max_keys:3 + 2 * max_keys]
+        children = fields[3 + 2 * max_keys:]
+        for i in range(num_keys):
+            if children[i] != 0:
+                self._read_legacy_node(children[i], pairs)
+            pairs.append((keys[i], values[i]))
+        if children[num_keys] != 0:
+            self._read_legacy_node(children[num_keys], pairs)
+
+    def _ensure_size(self, size):
+        if size <= len(self.mm):
+            return
+        chunk = PREALLOC_BLOCKS * BLOCK_SIZE
+        size = (size + chunk - 1) // chunk * chunk
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.f.fileno(), 0, size)
+            except OSError:
+                pass
+        self.mm.resize(size)
+
+    def _alloc_blocks(self, count=1):
+        first_id = self.header.next_block
+        self.header.next_block += count
+        self._ensure_size(self.header.next_block * BLOCK_SIZE)
+        return first_id
+
+    def _track_key(self, key):
+        h = self.header
+        if h.key_count == 0:
+            h.min_key = h.max_key = key
+        else:
+            h.min_key = min(h.min_key, key)
+            h.max_key = max(h.max_key, key)
+        h.key_count += 1
+        if h.key_count * BLOOM_BITS_PER_KEY > 1 << self.bloom.log2:
+            self.bloom = BloomFilter.sized_for(h.key_count)
+            for k, _ in self.traverse():
+                self.bloom.add(k)
+        self.bloom.add(key)
+
+    def _pin_top(self):
+        root_id = self.header.root_block
+        if root_id == 0:
+            return
+        root = self.cache.get(root_id)
+        top = [root_id]
+        for i in range(root.num_keys + 1):
+            if root.children[i] != 0:
+                top.append(root.children[i])
+        self.cache.pin(top)
+
     def search(self, key):
-        if self.header.root_block == 0:
+        if not fits_uint64(key):
             return None
+        if self.bloom is not None:
+            h = self.header
+            if h.key_count == 0 or key < h.min_key or key > h.max_key:
+                return None
+            if not self.bloom.might_contain(key):
+                return None
         return self._search_node(self.header.root_block, key)
 
     def _search_node(self, block_id, key):
-        node = self.cache.get(block_id)
-        i = 0
-        while i < node.num_keys and key > node.keys[i]:
-            i += 1
-        if i < node.num_keys and key == node.keys[i]:
-            return node.values[i]
-        if node.is_leaf():
-            return None
-        child_id = node.children[i]
-        if child_id == 0:
-            return None
-        return self._search_node(child_id, key)
+        while block_id != 0:
+            node = self.cache.get(block_id)
+            i = bisect_left(node.keys, key, 0, node.num_keys)
+            if i < node.num_keys and key == node.keys[i]:
+                return node.values[i]
+            if node.leaf:
+                return None
+            block_id = node.children[i]
+        return None
 
     def insert(self, key, value):
+        if not fits_uint64(key) or not fits_uint64(value):
+            raise OverflowError("key and value must fit in an unsigned 64-bit integer")
+        if self.bloom is not None:
+            self._track_key(key)
         if self.header.root_block == 0:
-            root_id = self.header.next_block
-            self.header.next_block += 1
+            root_id = self._alloc_blocks()
             self.header.root_block = root_id
             root = self.cache.new_node(root_id, 0)
             root.num_keys = 1
             root.keys[0] = key
             root.values[0] = value
             root.dirty = True
+            self._pin_top()
             return
         root = self.cache.get(self.header.root_block)
+        root_keys = root.num_keys
         if root.num_keys == MAX_KEYS:
-            new_root_id = self.header.next_block
-            self.header.next_block += 1
+            new_root_id = self._alloc_blocks()
             new_root = self.cache.new_node(new_root_id, 0)
             new_root.children[0] = root.block_id
+            new_root.leaf = False
             new_root.num_keys = 0
             root.parent_id = new_root_id
             root.dirty = True
             self.header.root_block = new_root_id
             self._split_child(new_root, 0)
             self._insert_nonfull(new_root, key, value)
+            self._pin_top()
         else:
             self._insert_nonfull(root, key, value)
+            if not root.leaf and root.num_keys != root_keys:
+                self._pin_top()
+
+    def bulk_load(self, pairs):
+        self.bloom = BloomFilter.sized_for(len(pairs))
+        for k, _ in pairs:
+            self.bloom.add(k)
+        self.header.key_count = len(pairs)
+        self.header.min_key = pairs[0][0]
+        self.header.max_key = pairs[-1][0]
+        children = None
+        pending = None
+        while True:
+            n = len(pairs)
+            count = (n + MAX_CHILDREN) // MAX_CHILDREN
+            first_id = self._alloc_blocks(count)
+            base, extra = divmod(n - count + 1, count)
+            nodes = []
+            separators = []
+            pos = 0
+            child_pos = 0
+            for j in range(count):
+                size = base + (1 if j < extra else 0)
+                node = Node(block_id=first_id + j)
+                chunk = pairs[pos:pos + size]
+                node.num_keys = size
+                node.keys[0:size] = array("Q", [k for k, _ in chunk])
+                node.values[0:size] = array("Q", [v for _, v in chunk])
+                if children is not None:
+                    node.children[0:size + 1] = array("Q", children[child_pos:child_pos + size + 1])
+                    node.leaf = False
+                    for child_id in children[child_pos:child_pos + size + 1]:
+                        pending[child_id - pending[0].block_id].parent_id = node.block_id
+                    child_pos += size + 1
+                pos += size
+                if j < count - 1:
+                    separators.append(pairs[pos])
+                    pos += 1
+                nodes.append(node)
+            if pending is not None:
+                for node in pending:
+                    node.write(self.mm)
+            if count == 1:
+                nodes[0].write(self.mm)
+                self.header.root_block = nodes[0].block_id
+                break
+            pairs = separators
+            children = [node.block_id for node in nodes]
+            pending = nodes
+        self._pin_top()
 
     def _split_child(self, parent, i):
         old_child_id = parent.children[i]
         old_child = self.cache.get(old_child_id)
-        new_child_id = self.header.next_block
-        self.header.next_block += 1
+        new_child_id = self._alloc_blocks()
         new_child = self.cache.new_node(new_child_id, parent.block_id)
+        new_child.leaf = old_child.leaf
         mid = T - 1
         new_child.num_keys = T - 1
-        for j in range(T - 1):
-            new_child.keys[j] = old_child.keys[j + T]
-            new_child.values[j] = old_child.values[j + T]
-        if not old_child.is_leaf():
-            for j in range(T):
-                new_child.children[j] = old_child.children[j + T]
+        new_child.keys[0:T - 1] = old_child.keys[T:MAX_KEYS]
+        new_child.values[0:T - 1] = old_child.values[T:MAX_KEYS]
+        if not old_child.leaf:
+            new_child.children[0:T] = old_child.children[T:MAX_CHILDREN]
         old_child.num_keys = mid
-        for j in range(parent.num_keys, i, -1):
-            parent.children[j + 1] = parent.children[j]
+        n = parent.num_keys
+        parent.children[i + 2:n + 2] = parent.children[i + 1:n + 1]
         parent.children[i + 1] = new_child_id
-        for j in range(parent.num_keys - 1, i - 1, -1):
-            parent.keys[j + 1] = parent.keys[j]
-            parent.values[j + 1] = parent.values[j]
+        parent.keys[i + 1:n + 1] = parent.keys[i:n]
+        parent.values[i + 1:n + 1] = parent.values[i:n]
         promote_key = old_child.keys[mid]
         promote_value = old_child.values[mid]
         parent.keys[i] = promote_key
@@ -257,20 +501,12 @@ class BTree:
         new_child.dirty = True
 
     def _insert_nonfull(self, node, key, value):
-        i = node.num_keys - 1
-        if node.is_leaf():
-            while i >= 0 and key < node.keys[i]:
-                node.keys[i + 1] = node.keys[i]
-                node.values[i + 1] = node.values[i]
-                i -= 1
-            node.keys[i + 1] = key
-            node.values[i + 1] = value
+        if node.leaf:
+            insert_shift(node.keys, node.values, node.num_keys, key, value)
             node.num_keys += 1
             node.dirty = True
         else:
-            while i >= 0 and key < node.keys[i]:
-                i -= 1
-            i += 1
+            i = bisect_right(node.keys, key, 0, node.num_keys)
             child_id = node.children[i]
             child = self.cache.get(child_id)
             if child.num_keys == MAX_KEYS:
@@ -281,19 +517,31 @@ class BTree:
                 child = self.cache.get(child_id)
             self._insert_nonfull(child, key, value)
 
-    def traverse(self, func):
+    def traverse(self):
         if self.header.root_block == 0:
             return
-        self._traverse_node(self.header.root_block, func)
+        stack = [(self.header.root_block, 0)]
+        while stack:
+            block_id, i = stack.pop()
+            node = self.cache.get(block_id)
+            if i > 0:
+                yield node.keys[i - 1], node.values[i - 1]
+            if node.leaf:
+                yield from zip(node.keys[:node.num_keys], node.values[:node.num_keys])
+                continue
+            if i < node.num_keys:
+                stack.append((block_id, i + 1))
+            stack.append((node.children[i], 0))
 
-    def _traverse_node(self, block_id, func):
-        node = self.cache.get(block_id)
-        for i in range(node.num_keys):
-            if node.children[i] != 0:
-                self._traverse_node(node.children[i], func)
-            func(node.keys[i], node.values[i])
-        if node.children[node.num_keys] != 0:
-            self._traverse_node(node.children[node.num_keys], func)
+
+def write_pairs(out, pairs, sep, end="\n"):
+    buf = []
+    for k, v in pairs:
+        buf.append(f"{k}{sep}{v}{end}")
+        if len(buf) >= OUTPUT_CHUNK:
+            out.write("".join(buf))
+            buf.clear()
+    out.write("".join(buf))
 
 
 def cmd_create(index_file):
@@ -304,8 +552,8 @@ def cmd_create(index_file):
     tree.close()
 
 
-def cmd_insert(index_file, key_str, value_str):
-    tree = BTree(index_file, must_exist=True)
+def cmd_insert(index_file, key_str, value_str, cache_size=DEFAULT_CACHE_SIZE):
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
     try:
         key = int(key_str)
         value = int(value_str)
@@ -313,12 +561,16 @@ def cmd_insert(index_file, key_str, value_str):
         print("Error: key and value must be integers")
         tree.close()
         sys.exit(1)
+    if not fits_uint64(key) or not fits_uint64(value):
+        print("Error: key and value must be between 0 and 2^64-1")
+        tree.close()
+        sys.exit(1)
     tree.insert(key, value)
     tree.close()
 
 
-def cmd_search(index_file, key_str):
-    tree = BTree(index_file, must_exist=True)
+def cmd_search(index_file, key_str, cache_size=DEFAULT_CACHE_SIZE):
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
     try:
         key = int(key_str)
     except ValueError:
@@ -333,85 +585,185 @@ def cmd_search(index_file, key_str):
     tree.close()
 
 
-def cmd_load(index_file, csv_file):
-    if not os.path.exists(csv_file):
-        print("Error: CSV file does not exist")
-        sys.exit(1)
-    tree = BTree(index_file, must_exist=True)
+def read_pairs(csv_file):
     with open(csv_file, newline="") as f:
-        reader = csv.reader(f)
-        for row in reader:
+        quoted = '"' in f.readline()
+        f.seek(0)
+        if quoted:
+            rows = csv.reader(f)
+        else:
+            rows = (line.split(",", 2) for line in f)
+        for row in rows:
             if len(row) < 2:
                 continue
             try:
-                key = int(row[0].strip())
-                value = int(row[1].strip())
+                key = int(row[0])
+                value = int(row[1])
             except ValueError:
                 continue
+            if not fits_uint64(key) or not fits_uint64(value):
+                continue
+            yield key, value
+
+
+def load_csv(tree, csv_file):
+    if tree.header.root_block != 0:
+        for key, value in read_pairs(csv_file):
             tree.insert(key, value)
-    tree.close()
+        return
+    pairs = list(read_pairs(csv_file))
+    if pairs:
+        pairs.sort(key=itemgetter(0))
+        tree.bulk_load(pairs)
 
 
-def cmd_print(index_file):
-    tree = BTree(index_file, must_exist=True)
+def cmd_load_bulk(index_file, csv_file, cache_size=DEFAULT_CACHE_SIZE):
+    if not os.path.exists(csv_file):
+        print("Error: CSV file does not exist")
+        sys.exit(1)
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
+    load_csv(tree, csv_file)
+    tree.close()
 
-    def out(k, v):
-        print(f"{k} {v}")
 
-    tree.traverse(out)
+def cmd_print(index_file, cache_size=DEFAULT_CACHE_SIZE):
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
+    write_pairs(sys.stdout, tree.traverse(), " ")
     tree.close()
 
 
-def cmd_extract(index_file, out_file):
+def cmd_extract(index_file, out_file, cache_size=DEFAULT_CACHE_SIZE):
     if os.path.exists(out_file):
         print("Error: output file exists")
         sys.exit(1)
-    tree = BTree(index_file, must_exist=True)
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
     with open(out_file, "w", newline="") as f:
-        writer = csv.writer(f)
+        write_pairs(f, tree.traverse(), ",", "\r\n")
+    tree.close()
 
-        def write_pair(k, v):
-            writer.writerow([k, v])
 
-        tree.traverse(write_pair)
-    tree.close()
+def cmd_batch(index_file, cache_size=DEFAULT_CACHE_SIZE):
+    tree = BTree(index_file, must_exist=True, cache_size=cache_size)
+    try:
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts:
+                continue
+            cmd = parts[0]
+            if cmd == "insert":
+                if len(parts) != 3:
+                    print("usage: insert <key> <value>")
+                    continue
+                try:
+                    key = int(parts[1])
+                    value = int(parts[2])
+                except ValueError:
+                    print("Error: key and value must be integers")
+                    continue
+                if not fits_uint64(key) or not fits_uint64(value):
+                    print("Error: key and value must be between 0 and 2^64-1")
+                    continue
+                tree.insert(key, value)
+            elif cmd == "search":
+                if len(parts) != 2:
+                    print("usage: search <key>")
+                    continue
+                try:
+                    key = int(parts[1])
+                except ValueError:
+                    print("Error: key must be integer")
+                    continue
+                res = tree.search(key)
+                if res is None:
+                    print("Error: key not found")
+                else:
+                    print(f"{key} {res}")
+            elif cmd == "load":
+                if len(parts) != 2:
+                    print("usage: load <csv>")
+                    continue
+                if not os.path.exists(parts[1]):
+                    print("Error: CSV file does not exist")
+                    continue
+                load_csv(tree, parts[1])
+            elif cmd == "print":
+                if len(parts) != 1:
+                    print("usage: print")
+                    continue
+                write_pairs(sys.stdout, tree.traverse(), " ")
+            elif cmd == "extract":
+                if len(parts) != 2:
+                    print("usage: extract <csv>")
+                    continue
+                if os.path.exists(parts[1]):
+                    print("Error: output file exists")
+                    continue
+                with open(parts[1], "w", newline="") as f:
+                    write_pairs(f, tree.traverse(), ",", "\r\n")
+            else:
+                print("Error: unknown command")
+    finally:
+        tree.close()
+
+
+def parse_cache_size(argv):
+    if "--lru_size" not in argv:
+        return DEFAULT_CACHE_SIZE
+    i = argv.index("--lru_size")
+    try:
+        cache_size = int(argv[i + 1])
+    except (IndexError, ValueError):
+        print("Error: lru_size must be an integer")
+        sys.exit(1)
+    if cache_size < MIN_CACHE_SIZE:
+        print(f"Error: lru_size must be at least {MIN_CACHE_SIZE}")
+        sys.exit(1)
+    del argv[i:i + 2]
+    return cache_size
 
 
 def main():
-    if len(sys.argv) < 3:
-        print("usage: project3 <command> <args>")
+    argv = sys.argv[:]
+    cache_size = parse_cache_size(argv)
+    if len(argv) < 3:
+        print("usage: project3 [--lru_size <nodes>] <command> <args>")
         sys.exit(1)
-    cmd = sys.argv[1]
+    cmd = argv[1]
     if cmd == "create":
-        if len(sys.argv) != 3:
+        if len(argv) != 3:
             print("usage: project3 create <index>")
             sys.exit(1)
-        cmd_create(sys.argv[2])
+        cmd_create(argv[2])
     elif cmd == "insert":
-        if len(sys.argv) != 5:
+        if len(argv) != 5:
             print("usage: project3 insert <index> <key> <value>")
             sys.exit(1)
-        cmd_insert(sys.argv[2], sys.argv[3], sys.argv[4])
+        cmd_insert(argv[2], argv[3], argv[4], cache_size)
     elif cmd == "search":
-        if len(sys.argv) != 4:
+        if len(argv) != 4:
             print("usage: project3 search <index> <key>")
             sys.exit(1)
-        cmd_search(sys.argv[2], sys.argv[3])
+        cmd_search(argv[2], argv[3], cache_size)
     elif cmd == "load":
-        if len(sys.argv) != 4:
+        if len(argv) != 4:
             print("usage: project3 load <index> <csv>")
             sys.exit(1)
-        cmd_load(sys.argv[2], sys.argv[3])
+        cmd_load_bulk(argv[2], argv[3], cache_size)
     elif cmd == "print":
-        if len(sys.argv) != 3:
+        if len(argv) != 3:
             print("usage: project3 print <index>")
             sys.exit(1)
-        cmd_print(sys.argv[2])
+        cmd_print(argv[2], cache_size)
     elif cmd == "extract":
-        if len(sys.argv) != 4:
+        if len(argv) != 4:
             print("usage: project3 extract <index> <csv>")
             sys.exit(1)
-        cmd_extract(sys.argv[2], sys.argv[3])
+        cmd_extract(argv[2], argv[3], cache_size)
+    elif cmd == "batch":
+        if len(argv) != 3:
+            print("usage: project3 batch <index>")
+            sys.exit(1)
+        cmd_batch(argv[2], cache_size)
     else:
         print("Error: unknown command")
         sys.exit(1)